@@ -1,8 +1,10 @@
+import math
 from collections import deque
 from decimal import Decimal
-from typing import Any, List
+from typing import Any, Callable, List, Optional, Sequence
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 from dojo.actions.base_action import BaseAction
 from dojo.actions.uniswapV3 import UniswapV3Trade
@@ -10,6 +12,104 @@ from dojo.agents import BaseAgent
 from dojo.environments.uniswapV3 import UniswapV3Observation
 from dojo.policies import BasePolicy
 
+import policy_kernels
+from policy_kernels import RECENTRE_RATIO, RESYNC_INTERVAL, new_state, update_indicators
+
+_TRADE_FRACTION = Decimal("0.3")  # Share of the held asset traded on each signal
+_ZERO = Decimal(0)
+
+# Token pair per pool name, shared by every policy instance; a pool's tokens never change
+_POOL_TOKENS: dict[str, tuple[str, str]] = {}
+
+
+def cached_pool_tokens(obs: UniswapV3Observation, pool: str) -> tuple[str, str]:
+    """Return ``obs.pool_tokens(pool)``, fetching it only the first time any policy asks for ``pool``."""
+    tokens = _POOL_TOKENS.get(pool)
+    if tokens is None:
+        tokens = _POOL_TOKENS[pool] = obs.pool_tokens(pool=pool)
+    return tokens
+
+
+def _rolling_mean_std(prices: np.ndarray, window: int) -> tuple[np.ndarray, np.ndarray]:
+    """Rolling mean and population std of ``prices``, 0.0 until the window has filled."""
+    n = len(prices)
+    means, stds = np.zeros(n), np.zeros(n)
+    if n >= window:
+        windows = sliding_window_view(prices, window)
+        means[window - 1:] = windows.mean(axis=1)
+        stds[window - 1:] = windows.std(axis=1)
+    return means, stds
+
+
+def rolling_correlation(prices: Sequence[float], liquidity: Sequence[float], corr_window: int) -> np.ndarray:
+    """Rolling price/liquidity correlation, 0.0 until the window has filled or when either series is flat."""
+    prices = np.asarray(prices, dtype=np.float64)
+    liquidity = np.asarray(liquidity, dtype=np.float64)
+    corr = np.zeros(len(prices))
+    if len(prices) >= corr_window:
+        # Same shifted running-sum formula as calculate_correlation, shifted by each window's first pair
+        dx = sliding_window_view(prices, corr_window)
+        dy = sliding_window_view(liquidity, corr_window)
+        dx = dx - dx[:, :1]
+        dy = dy - dy[:, :1]
+        sx, sy = dx.sum(axis=1), dy.sum(axis=1)
+        sxx, syy = np.einsum("ij,ij->i", dx, dx), np.einsum("ij,ij->i", dy, dy)
+        sxy = np.einsum("ij,ij->i", dx, dy)
+        cov = corr_window * sxy - sx * sy
+        var_x = corr_window * sxx - sx * sx
+        var_y = corr_window * syy - sy * sy
+        # Flat when every value equals the window's first, as the online paths detect from runs of equal values
+        valid = dx.any(axis=1) & dy.any(axis=1) & (var_x > 0.0) & (var_y > 0.0)
+        corr[corr_window - 1:] = np.where(valid, cov / np.sqrt(np.where(valid, var_x * var_y, 1.0)), 0.0)
+    return corr
+
+
+def rolling_indicators(
+    prices: Sequence[float], liquidity: Sequence[float], window: int, std_dev_multiplier: float, corr_window: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Vectorised Bollinger Bands and price/liquidity correlation over a whole series.
+
+    Entry ``t`` of each returned array (lower, middle, upper, correlation) equals what the online
+    calculation gives after observing step ``t``, and is 0.0 until the respective window has filled.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    middle, stds = _rolling_mean_std(prices, window)
+    upper = middle + stds * std_dev_multiplier
+    lower = middle - stds * std_dev_multiplier
+    return lower, middle, upper, rolling_correlation(prices, liquidity, corr_window)
+
+
+def precompute_signals(
+    prices: Sequence[float], liquidity: Sequence[float], windows: Sequence[int], ks: Sequence[float], corr_window: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Buy and sell signals for every (window, std_dev_multiplier) pair of a parameter sweep in one pass.
+
+    Returns boolean ``buy`` and ``sell`` tensors of shape ``(T, len(windows), len(ks))`` and the shared
+    correlation series of shape ``(T,)``. A signal is set where the price is outside the respective band
+    with correlation below -0.5, once both windows have filled; direction is left to the consumer.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    ks = np.asarray(ks, dtype=np.float64)
+    n = len(prices)
+    corr = rolling_correlation(prices, liquidity, corr_window)
+
+    # (T, W) rolling statistics, one column per window size
+    means = np.empty((n, len(windows)))
+    stds = np.empty((n, len(windows)))
+    ready = np.empty((n, len(windows)), dtype=bool)
+    for i, window in enumerate(windows):
+        means[:, i], stds[:, i] = _rolling_mean_std(prices, window)
+        ready[:, i] = np.arange(n) >= max(window, corr_window) - 1
+
+    # Broadcast to (T, W, K)
+    widths = stds[:, :, np.newaxis] * ks[np.newaxis, np.newaxis, :]
+    gate = (ready & (corr < -0.5)[:, np.newaxis])[:, :, np.newaxis]
+    price = prices[:, np.newaxis, np.newaxis]
+    buy = gate & (price < means[:, :, np.newaxis] - widths)
+    sell = gate & (price > means[:, :, np.newaxis] + widths)
+    return buy, sell, corr
+
+
 class BollingerBandsPolicy(BasePolicy):
     """Bollinger Bands trading strategy using SMA and correlation for a UniswapV3Env with a single pool.
 
@@ -19,6 +119,11 @@ class BollingerBandsPolicy(BasePolicy):
     :param std_dev_multiplier: The multiplier for the standard deviation to set band widths.
     :param corr_window: The window size for calculating rolling correlation.
     :param direction: The trade direction; 0 for all, -1 for short only, 1 for long only.
+
+    ``calculate_sma``, ``calculate_bollinger_bands`` and ``calculate_correlation`` report the state of
+    whichever online path predict() feeds: the numba kernel when it is available, otherwise the pure
+    Python windows behind ``update_price_window`` and ``update_history``. With precomputed indicators
+    or sweep signals neither is fed, and those methods report the "not enough data" defaults.
     """
 
     def __init__(
@@ -30,104 +135,316 @@ class BollingerBandsPolicy(BasePolicy):
         self.std_dev_multiplier = std_dev_multiplier
         self.corr_window = corr_window  # Window for calculating rolling correlation
         self.direction = direction  # 0 for both, -1 for short only, 1 for long only
+        self._pool_tokens: Optional[tuple[str, str]] = None  # Fetched once on the first predict
+        self._price_args: tuple[str, str, str] = ("", "", pool)  # (token, unit, pool) for obs.price
         self.price_window: deque[float] = deque(maxlen=window)
-        self.price_hist = []
-        self.liquidity = []
-        self.upper_band = []
-        self.lower_band = []
-        self.correlation_hist = []
+        self._sum = 0.0  # Running sum of price_window for O(1) SMA
+        self._sumsq = 0.0  # Running sum of squares of price_window for O(1) std
+        self._updates = 0
+        # Number of identical trailing prices; the running sums drift off a flat window, so it is handled exactly
+        self._p_run = 0
+        # Parallel ring buffers of price and liquidity over the correlation window
+        self._p_ring = np.zeros(corr_window, dtype=np.float64)
+        self._l_ring = np.zeros(corr_window, dtype=np.float64)
+        self._ring_idx = 0
+        self._ring_count = 0
+        # Running sums over the correlation window, taken relative to (_x0, _y0) to limit cancellation.
+        # The centre is moved to the window mean every corr_window updates, and before a correlation is
+        # taken if it has drifted far from the window, so it never goes stale
+        self._x0 = self._y0 = 0.0
+        self._sx = self._sy = self._sxx = self._syy = self._sxy = 0.0
+        # Number of identical trailing prices/liquidity values; a window is flat once a run covers it
+        self._x_run = self._y_run = 0
+        # Indicator series from precompute(), indexed by step; None means compute online
+        self._precomputed: Optional[tuple[list[float], list[float], list[float], list[float]]] = None
+        # Signals taken from a precompute_signals() sweep, indexed by step; None means not in sweep mode
+        self._signals: Optional[tuple[list[bool], list[bool], list[float]]] = None
+        self._step = 0  # Number of predict() calls so far
+        self._warmup_steps = max(window, corr_window)
+        # Band crossing checks with direction and multiplier folded in; fixed for the life of the policy
+        self._crossed_side, self._crossed_side_online = self._build_side_checks()
+        # State for the compiled kernel; None when numba is unavailable
+        self._kernel_state = None
+        if update_indicators is not None:
+            update_indicators(0.0, 0.0, std_dev_multiplier, *new_state(window, corr_window))  # Pay the JIT cost up front
+            self._kernel_state = new_state(window, corr_window)
+
+    def precompute(self, prices: Sequence[float], liquidity: Sequence[float]) -> None:
+        """Precompute the indicators for a known (e.g. replayed) price and liquidity series.
+
+        predict() then looks up step ``t`` instead of updating the rolling windows. The series must
+        cover every step of the run, starting from the first call to predict().
+        """
+        lower, middle, upper, corr = rolling_indicators(
+            prices, liquidity, self.window, self.std_dev_multiplier, self.corr_window
+        )
+        # Plain lists so that per-step indexing yields Python floats
+        self._precomputed = (lower.tolist(), middle.tolist(), upper.tolist(), corr.tolist())
+
+    def use_signals(
+        self, buy: np.ndarray, sell: np.ndarray, correlation: np.ndarray, windows: Sequence[int], ks: Sequence[float]
+    ) -> None:
+        """Trade from a precompute_signals() sweep, picking the slice for this policy's parameters.
+
+        ``windows`` and ``ks`` are the grids the sweep was built from and must contain ``window`` and
+        (up to float rounding, e.g. from ``np.arange``) ``std_dev_multiplier``; the sweep must use the
+        same ``corr_window`` and cover every step of the run.
+        """
+        window_matches = np.flatnonzero(np.asarray(windows) == self.window)
+        if window_matches.size == 0:
+            raise ValueError(f"window {self.window} is not in the sweep's windows {list(windows)}")
+        k_matches = np.flatnonzero(np.isclose(np.asarray(ks, dtype=np.float64), self.std_dev_multiplier))
+        if k_matches.size == 0:
+            raise ValueError(f"std_dev_multiplier {self.std_dev_multiplier} is not in the sweep's ks {list(ks)}")
+        w, k = window_matches[0], k_matches[0]
+        steps = len(correlation)
+        no_signal = [False] * steps
+        self._signals = (
+            buy[:, w, k].tolist() if self.direction >= 0 else no_signal,
+            sell[:, w, k].tolist() if self.direction <= 0 else no_signal,
+            correlation.tolist(),
+        )
 
     def calculate_sma(self) -> float:
         """Calculate the Simple Moving Average (SMA) based on the price window."""
-        return np.mean(self.price_window)
+        if self._kernel_state is not None:
+            ring_p, _, _, state, sums = self._kernel_state
+            return float(policy_kernels.sma(ring_p, state, sums))
+        if not self.price_window:
+            return 0.0  # Not enough data yet
+        if self._p_run >= len(self.price_window):
+            return self.price_window[-1]  # Flat window
+        return self._sum / len(self.price_window)
+
+    def update_price_window(self, price: float) -> None:
+        """Append a price to the rolling window, keeping the running sums in step."""
+        old = self.price_window[0] if len(self.price_window) == self.window else 0.0  # Value about to be evicted
+        self._p_run = self._p_run + 1 if self.price_window and price == self.price_window[-1] else 1
+        self.price_window.append(price)
+        self._sum += price - old
+        self._sumsq += price * price - old * old
+
+        self._updates += 1
+        if self._updates % RESYNC_INTERVAL == 0:
+            self._sum = math.fsum(self.price_window)
+            self._sumsq = math.fsum(p * p for p in self.price_window)
+
+    def update_history(self, price: float, liquidity: float) -> None:
+        """Append a price/liquidity pair to the correlation window, keeping the running sums in step."""
+        idx = self._ring_idx
+        if self._ring_count == 0:
+            self._x0, self._y0 = price, liquidity
+            self._x_run = self._y_run = 1
+        else:
+            last = idx - 1  # Index -1 wraps to the end of the ring
+            self._x_run = self._x_run + 1 if price == self._p_ring.item(last) else 1
+            self._y_run = self._y_run + 1 if liquidity == self._l_ring.item(last) else 1
+        if self._ring_count == self.corr_window:
+            xo = self._p_ring.item(idx) - self._x0  # Pair about to be overwritten
+            yo = self._l_ring.item(idx) - self._y0
+            self._sx -= xo
+            self._sy -= yo
+            self._sxx -= xo * xo
+            self._syy -= yo * yo
+            self._sxy -= xo * yo
+        self._p_ring[idx] = price
+        self._l_ring[idx] = liquidity
+        self._ring_idx = (idx + 1) % self.corr_window
+        self._ring_count = min(self._ring_count + 1, self.corr_window)
+        x = price - self._x0
+        y = liquidity - self._y0
+        self._sx += x
+        self._sy += y
+        self._sxx += x * x
+        self._syy += y * y
+        self._sxy += x * y
+
+        if self._ring_idx == 0:  # Ring has wrapped, i.e. once every corr_window updates
+            self._resync_correlation()
+
+    def _resync_correlation(self) -> None:
+        """Rebuild the correlation sums from the window, re-centring on its current mean."""
+        n = self._ring_count
+        prices = self._p_ring[:n].tolist()  # Order within the ring does not matter for the sums
+        liquidity = self._l_ring[:n].tolist()
+        self._x0 = math.fsum(prices) / n
+        self._y0 = math.fsum(liquidity) / n
+        xs = [p - self._x0 for p in prices]
+        ys = [l - self._y0 for l in liquidity]
+        self._sx = math.fsum(xs)
+        self._sy = math.fsum(ys)
+        self._sxx = math.fsum(x * x for x in xs)
+        self._syy = math.fsum(y * y for y in ys)
+        self._sxy = math.fsum(x * y for x, y in zip(xs, ys))
 
     def calculate_bollinger_bands(self) -> tuple[float, float, float]:
         """Calculate the Bollinger Bands based on the SMA."""
+        if self._kernel_state is not None:
+            ring_p, _, _, state, sums = self._kernel_state
+            return policy_kernels.bands(self.std_dev_multiplier, ring_p, state, sums)
         if len(self.price_window) < self.window:
             return 0.0, 0.0, 0.0  # Not enough data yet
 
         middle_band = self.calculate_sma()  # Use SMA for the middle band
-        std_dev = np.std(self.price_window)
+        if self._p_run >= self.window:
+            return middle_band, middle_band, middle_band  # Flat window, zero volatility
+        variance = max(self._sumsq / len(self.price_window) - middle_band * middle_band, 0.0)
+        std_dev = math.sqrt(variance)
         upper_band = middle_band + (std_dev * self.std_dev_multiplier)
         lower_band = middle_band - (std_dev * self.std_dev_multiplier)
 
-        # Save bands for analysis or debugging
-        self.upper_band.append(upper_band)
-        self.lower_band.append(lower_band)
-        
         return lower_band, middle_band, upper_band
 
     def calculate_correlation(self) -> float:
         """Calculate the rolling correlation between price and liquidity."""
-        if len(self.price_hist) >= self.corr_window and len(self.liquidity) >= self.corr_window:
-            # Extract the most recent `corr_window` values
-            prices = np.array(self.price_hist[-self.corr_window:], dtype=float)
-            liquidity = np.array(self.liquidity[-self.corr_window:], dtype=float)
+        if self._kernel_state is not None:
+            _, ring_x, ring_y, state, sums = self._kernel_state
+            return policy_kernels.correlation(ring_x, ring_y, state, sums)
+        n = self._ring_count
+        if n < self.corr_window:
+            return 0.0  # Default correlation when insufficient data
+
+        cov = n * self._sxy - self._sx * self._sy
+        var_x = n * self._sxx - self._sx * self._sx
+        var_y = n * self._syy - self._sy * self._sy
+        if var_x < RECENTRE_RATIO * n * self._sxx or var_y < RECENTRE_RATIO * n * self._syy:
+            self._resync_correlation()  # Centre is far from the window mean, most digits would cancel
+            cov = n * self._sxy - self._sx * self._sy
+            var_x = n * self._sxx - self._sx * self._sx
+            var_y = n * self._syy - self._sy * self._sy
+        if self._x_run >= n or self._y_run >= n or var_x <= 0.0 or var_y <= 0.0:
+            return 0.0  # Flat price or liquidity, correlation is undefined
+        return cov / math.sqrt(var_x * var_y)
+
+    def _build_side_checks(self) -> tuple[Callable[[float, float, float], int], Callable[[float], int]]:
+        """Build the band crossing checks used by predict, specialised for direction and std_dev_multiplier.
+
+        Both return 1 if price is below the lower band, -1 if above the upper band, else 0, and only check
+        the sides direction allows. The online check works from the running sums of a full window: the
+        side of the SMA is checked first and the distance is compared with the band width in squared
+        form, so no bands are built and no square root is taken on ticks that cannot trade. A flat window
+        is caught from the run of equal prices first, since the running sums drift off its exact mean.
+        """
+        window = self.window
+        width_sq = self.std_dev_multiplier * self.std_dev_multiplier
+
+        if self.direction > 0:  # Long only
+
+            def crossed_side(price: float, lower_band: float, upper_band: float) -> int:
+                return 1 if price < lower_band else 0
 
-            # Ensure arrays are of the same shape and dimension
-            if prices.shape == liquidity.shape and prices.ndim == 1:
-                corr = np.corrcoef(prices, liquidity)[0, 1]
-                self.correlation_hist.append(corr)
-                return corr
-        return 0.0  # Default correlation when insufficient data
+            def crossed_side_online(price: float) -> int:
+                if self._p_run >= window:
+                    return 0  # Flat window, the price sits on all three bands
+                middle_band = self._sum / window
+                distance = price - middle_band
+                if distance >= 0:
+                    return 0
+                return 1 if distance * distance > (self._sumsq / window - middle_band * middle_band) * width_sq else 0
 
+        elif self.direction < 0:  # Short only
+
+            def crossed_side(price: float, lower_band: float, upper_band: float) -> int:
+                return -1 if price > upper_band else 0
+
+            def crossed_side_online(price: float) -> int:
+                if self._p_run >= window:
+                    return 0  # Flat window, the price sits on all three bands
+                middle_band = self._sum / window
+                distance = price - middle_band
+                if distance <= 0:
+                    return 0
+                return -1 if distance * distance > (self._sumsq / window - middle_band * middle_band) * width_sq else 0
+
+        else:  # Both
+
+            def crossed_side(price: float, lower_band: float, upper_band: float) -> int:
+                if price < lower_band:
+                    return 1
+                return -1 if price > upper_band else 0
+
+            def crossed_side_online(price: float) -> int:
+                if self._p_run >= window:
+                    return 0  # Flat window, the price sits on all three bands
+                middle_band = self._sum / window
+                distance = price - middle_band
+                if distance == 0 or distance * distance <= (self._sumsq / window - middle_band * middle_band) * width_sq:
+                    return 0
+                return 1 if distance < 0 else -1
+
+        return crossed_side, crossed_side_online
 
     def predict(self, obs: UniswapV3Observation) -> List[BaseAction[Any]]:
         """Generate trade signals based on Bollinger Bands with SMA and correlation."""
-        pool = obs.pools[0]
-        pool_tokens = obs.pool_tokens(pool=self.pool)
-        
-        # Fetch current price and liquidity, and update data history in every step
-        price = float(obs.price(token=pool_tokens[0], unit=pool_tokens[1], pool=self.pool))
-        self.price_window.append(price)
-        self.price_hist.append(price)
-        self.liquidity.append(obs.liquidity(pool))  # Ensure liquidity is added every step
+        if self._pool_tokens is None:
+            self._pool_tokens = cached_pool_tokens(obs, self.pool)
+            self._price_args = (self._pool_tokens[0], self._pool_tokens[1], self.pool)
+        pool_tokens = self._pool_tokens
 
-        # Calculate Bollinger Bands and rolling correlation
-        lower_band, middle_band, upper_band = self.calculate_bollinger_bands()
-        correlation = self.calculate_correlation()
-        obs.add_signal("Correlation", correlation)
-        """Generate trade signals based on Bollinger Bands with SMA and correlation."""
-        pool = obs.pools[0]
-        pool_tokens = obs.pool_tokens(pool=self.pool)
-        
-        # Fetch current price and liquidity, and update data history
-        price = float(obs.price(token=pool_tokens[0], unit=pool_tokens[1], pool=self.pool))
-        self.price_window.append(price)
-        self.price_hist.append(price)
-        self.liquidity.append(obs.liquidity(pool))
+        # Only start trading once both the Bollinger and correlation windows have filled
+        step = self._step
+        self._step += 1
+        warming_up = self._step < self._warmup_steps
 
-        # Calculate Bollinger Bands and rolling correlation
-        lower_band, middle_band, upper_band = self.calculate_bollinger_bands()
-        correlation = self.calculate_correlation()
-        obs.add_signal("Correlation", correlation)
+        if self._signals is not None:
+            if warming_up:
+                return []
+            # Look up the sweep signals for this step; direction is already applied
+            buy, sell, correlations = self._signals
+            side = 1 if buy[step] else -1 if sell[step] else 0
+            correlation = correlations[step]
+        elif self._precomputed is not None:
+            if warming_up:
+                return []
+            # Look up the indicators precomputed for this step
+            price = float(obs.price(*self._price_args))
+            lower_band, _, upper_band, correlation = (series[step] for series in self._precomputed)
+            side = self._crossed_side(price, lower_band, upper_band)
+        else:
+            # Fetch current price and liquidity, and update data history
+            price = float(obs.price(*self._price_args))
+            liquidity = float(obs.liquidity(self.pool))  # Ensure liquidity is added every step
+            if self._kernel_state is not None:
+                lower_band, _, upper_band, correlation = update_indicators(
+                    price, liquidity, self.std_dev_multiplier, *self._kernel_state
+                )
+                if warming_up:
+                    return []
+                side = self._crossed_side(price, lower_band, upper_band)
+            else:
+                self.update_price_window(price)
+                self.update_history(price, liquidity)
+                if warming_up:
+                    return []
+                side = self._crossed_side_online(price)
+                correlation = None  # Only computed once a band has been crossed
 
-        # Only start trading when enough data is available
-        if len(self.price_window) < self.window:
-            return []
+        if side == 0:
+            return []  # Price is inside the bands, or outside on a side direction rules out
+
+        if correlation is None:
+            correlation = self.calculate_correlation()
+        obs.add_signal("Correlation", correlation)
+        if correlation >= -0.5:
+            return []  # No inverse relationship between price and liquidity
 
-        actions = []
-        
         # Buy Signal: Price crosses below lower band, and correlation suggests an inverse relationship
-        if self.direction >= 0 and price < lower_band and correlation < -0.5:  # Long trades or both
-            y_quantity = self.agent.quantity(pool_tokens[1]) * Decimal("0.3")  # Trade 10% of asset y
-            actions.append(
+        if side > 0:
+            y_quantity = self.agent.quantity(pool_tokens[1]) * _TRADE_FRACTION  # Trade 30% of asset y
+            return [
                 UniswapV3Trade(
                     agent=self.agent,
                     pool=self.pool,
-                    quantities=(Decimal(0), y_quantity),  # Buy action
+                    quantities=(_ZERO, y_quantity),  # Buy action
                 )
-            )
+            ]
 
         # Sell Signal: Price crosses above upper band, and correlation suggests an inverse relationship
-        if self.direction <= 0 and price > upper_band and correlation < -0.5:  # Short trades or both
-            x_quantity = self.agent.quantity(pool_tokens[0]) * Decimal("0.3")  # Trade 10% of asset x
-            actions.append(
-                UniswapV3Trade(
-                    agent=self.agent,
-                    pool=self.pool,
-                    quantities=(x_quantity, Decimal(0)),  # Sell action
-                )
+        x_quantity = self.agent.quantity(pool_tokens[0]) * _TRADE_FRACTION  # Trade 30% of asset x
+        return [
+            UniswapV3Trade(
+                agent=self.agent,
+                pool=self.pool,
+                quantities=(x_quantity, _ZERO),  # Sell action
             )
-
-        return actions
+        ]
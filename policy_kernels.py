@@ -0,0 +1,189 @@
+"""Compiled rolling indicator kernel used by BollingerBandsPolicy.
+
+numba is optional. Without it ``update_indicators`` (and the ``sma``, ``bands`` and ``correlation``
+readers of its state) are None and the policy keeps to its pure Python running sums, which use the
+same formulas.
+"""
+import math
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is not installed
+    njit = None
+
+# Recompute the running sums from scratch this often to stop floating point drift
+RESYNC_INTERVAL = 1000
+# Re-centre the correlation sums before use when the centred spread is below this fraction of the
+# second moment about the current centre
+RECENTRE_RATIO = 1e-2
+
+# Layout of the integer state array
+POS_P, COUNT_P, POS_C, COUNT_C, UPDATES, RUN_X, RUN_Y, RUN_P = range(8)
+# Layout of the running sums array
+SUM_P, SUMSQ_P, X0, Y0, SX, SY, SXX, SYY, SXY = range(9)
+
+
+def new_state(window: int, corr_window: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Allocate the ring buffers and accumulators consumed by ``update_indicators``."""
+    return (
+        np.zeros(window, dtype=np.float64),  # Prices for the Bollinger window
+        np.zeros(corr_window, dtype=np.float64),  # Prices for the correlation window
+        np.zeros(corr_window, dtype=np.float64),  # Liquidity for the correlation window
+        np.zeros(8, dtype=np.int64),
+        np.zeros(9, dtype=np.float64),
+    )
+
+
+def _resync_prices(ring_p, state, sums):
+    n = state[COUNT_P]
+    s = 0.0
+    ss = 0.0
+    for i in range(n):
+        s += ring_p[i]
+        ss += ring_p[i] * ring_p[i]
+    sums[SUM_P] = s
+    sums[SUMSQ_P] = ss
+
+
+def _resync_correlation(ring_x, ring_y, state, sums):
+    m = state[COUNT_C]
+    x0 = 0.0
+    y0 = 0.0
+    for i in range(m):
+        x0 += ring_x[i]
+        y0 += ring_y[i]
+    x0 /= m
+    y0 /= m
+    sx = sy = sxx = syy = sxy = 0.0
+    for i in range(m):
+        x = ring_x[i] - x0
+        y = ring_y[i] - y0
+        sx += x
+        sy += y
+        sxx += x * x
+        syy += y * y
+        sxy += x * y
+    sums[X0] = x0
+    sums[Y0] = y0
+    sums[SX] = sx
+    sums[SY] = sy
+    sums[SXX] = sxx
+    sums[SYY] = syy
+    sums[SXY] = sxy
+
+
+def _sma(ring_p, state, sums):
+    """Return the mean of the prices in the Bollinger window so far, 0.0 while it is empty."""
+    n = state[COUNT_P]
+    if n == 0:
+        return 0.0
+    if state[RUN_P] >= n:
+        return ring_p[(state[POS_P] - 1) % ring_p.shape[0]]  # Flat window, the sums have drifted off it
+    return sums[SUM_P] / n
+
+
+def _bands(std_dev_multiplier, ring_p, state, sums):
+    """Return (lower, middle, upper) for the Bollinger window, all 0.0 until it has filled."""
+    n = state[COUNT_P]
+    if n < ring_p.shape[0]:
+        return 0.0, 0.0, 0.0
+    middle = _sma(ring_p, state, sums)
+    if state[RUN_P] >= n:
+        return middle, middle, middle  # Flat window, zero volatility
+    width = math.sqrt(max(sums[SUMSQ_P] / n - middle * middle, 0.0)) * std_dev_multiplier
+    return middle - width, middle, middle + width
+
+
+def _correlation(ring_x, ring_y, state, sums):
+    """Return the correlation over the correlation window, 0.0 until it has filled or when either series is flat."""
+    m = state[COUNT_C]
+    if m < ring_x.shape[0] or state[RUN_X] >= m or state[RUN_Y] >= m:
+        return 0.0
+    var_x = m * sums[SXX] - sums[SX] * sums[SX]
+    var_y = m * sums[SYY] - sums[SY] * sums[SY]
+    if var_x < RECENTRE_RATIO * m * sums[SXX] or var_y < RECENTRE_RATIO * m * sums[SYY]:
+        _resync_correlation(ring_x, ring_y, state, sums)  # Centre is far from the window mean
+        var_x = m * sums[SXX] - sums[SX] * sums[SX]
+        var_y = m * sums[SYY] - sums[SY] * sums[SY]
+    if var_x <= 0.0 or var_y <= 0.0:
+        return 0.0
+    return (m * sums[SXY] - sums[SX] * sums[SY]) / math.sqrt(var_x * var_y)
+
+
+def _update_indicators(price, liquidity, std_dev_multiplier, ring_p, ring_x, ring_y, state, sums):
+    """Push one (price, liquidity) observation and return (lower, middle, upper, correlation).
+
+    Bands are 0.0 until the Bollinger window has filled and correlation is 0.0 until the correlation
+    window has filled or when either series is flat.
+    """
+    # Bollinger window
+    window = ring_p.shape[0]
+    pos = state[POS_P]
+    n = state[COUNT_P]
+    old = ring_p[pos] if n == window else 0.0  # Value about to be overwritten
+    state[RUN_P] = state[RUN_P] + 1 if n > 0 and price == ring_p[(pos - 1) % window] else 1
+    ring_p[pos] = price
+    state[POS_P] = (pos + 1) % window
+    if n < window:
+        n += 1
+        state[COUNT_P] = n
+    sums[SUM_P] += price - old
+    sums[SUMSQ_P] += price * price - old * old
+
+    state[UPDATES] += 1
+    if state[UPDATES] % RESYNC_INTERVAL == 0:
+        _resync_prices(ring_p, state, sums)
+
+    # Correlation window, with sums taken relative to (x0, y0) to limit cancellation
+    corr_window = ring_x.shape[0]
+    pos = state[POS_C]
+    m = state[COUNT_C]
+    if m == 0:
+        sums[X0] = price
+        sums[Y0] = liquidity
+        state[RUN_X] = 1
+        state[RUN_Y] = 1
+    else:
+        last = (pos - 1) % corr_window
+        state[RUN_X] = state[RUN_X] + 1 if price == ring_x[last] else 1
+        state[RUN_Y] = state[RUN_Y] + 1 if liquidity == ring_y[last] else 1
+    if m == corr_window:
+        xo = ring_x[pos] - sums[X0]  # Pair about to be overwritten
+        yo = ring_y[pos] - sums[Y0]
+        sums[SX] -= xo
+        sums[SY] -= yo
+        sums[SXX] -= xo * xo
+        sums[SYY] -= yo * yo
+        sums[SXY] -= xo * yo
+    ring_x[pos] = price
+    ring_y[pos] = liquidity
+    state[POS_C] = (pos + 1) % corr_window
+    if m < corr_window:
+        m += 1
+        state[COUNT_C] = m
+    x = price - sums[X0]
+    y = liquidity - sums[Y0]
+    sums[SX] += x
+    sums[SY] += y
+    sums[SXX] += x * x
+    sums[SYY] += y * y
+    sums[SXY] += x * y
+
+    if state[POS_C] == 0:  # Ring has wrapped, re-centre on the window mean
+        _resync_correlation(ring_x, ring_y, state, sums)
+
+    lower, middle, upper = _bands(std_dev_multiplier, ring_p, state, sums)
+    return lower, middle, upper, _correlation(ring_x, ring_y, state, sums)
+
+
+if njit is not None:
+    _resync_prices = njit(cache=True, nogil=True)(_resync_prices)
+    _resync_correlation = njit(cache=True, nogil=True)(_resync_correlation)
+    sma = _sma = njit(cache=True, nogil=True)(_sma)
+    bands = _bands = njit(cache=True, nogil=True)(_bands)
+    correlation = _correlation = njit(cache=True, nogil=True)(_correlation)
+    update_indicators = njit(cache=True, nogil=True)(_update_indicators)
+else:
+    sma = bands = correlation = update_indicators = None
@@ -4,7 +4,6 @@ import sys
 from datetime import timedelta
 from decimal import Decimal
 import numpy as np
-import matplotlib.pyplot as plt
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
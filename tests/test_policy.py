@@ -0,0 +1,224 @@
+import math
+import os
+import random
+import sys
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+pytest.importorskip("dojo")
+
+from policy import BollingerBandsPolicy  # noqa: E402
+
+
+class FakeAgent:
+    """Stands in for the trading agent; only quantity() is used by the policy."""
+
+    def quantity(self, token: str) -> Decimal:
+        return Decimal(1000)
+
+
+class FakeObservation:
+    """Replays one (price, liquidity) pair per step for a single pool."""
+
+    pools = ["USDC/WETH-0.05"]
+
+    def __init__(self) -> None:
+        self.current_price = Decimal(0)
+        self.current_liquidity = 0
+
+    def pool_tokens(self, pool: str) -> tuple[str, str]:
+        return ("USDC", "WETH")
+
+    def price(self, token: str, unit: str, pool: str) -> Decimal:
+        return self.current_price
+
+    def liquidity(self, pool: str) -> int:
+        return self.current_liquidity
+
+    def add_signal(self, name: str, value: float) -> None:
+        pass
+
+
+def drifting_series(
+    seed: int, steps: int = 3000, hold: float = 0.0, price_hold: float = 0.0
+) -> list[tuple[Decimal, int]]:
+    """Random walk price against liquidity around 1e22 with small noise and occasional 1% jumps.
+
+    Liquidity is left unchanged on a ``hold`` fraction of steps and the price on a ``price_hold``
+    fraction, so some windows are flat.
+    """
+    rng = random.Random(seed)
+    price = 2000.0
+    liquidity = 10**22
+    series = []
+    for _ in range(steps):
+        if rng.random() >= price_hold:
+            price *= math.exp(rng.gauss(0, 0.003))
+        if rng.random() < hold:
+            series.append((Decimal(price), liquidity))
+            continue
+        liquidity += int(rng.gauss(0, 1) * 10**16)
+        if rng.random() < 0.1:
+            liquidity = int(liquidity * (1 + rng.choice((-1, 1)) * 0.01))
+        series.append((Decimal(price), liquidity))
+    return series
+
+
+def make_policy(**kwargs) -> BollingerBandsPolicy:
+    params = dict(pool="USDC/WETH-0.05", window=20, std_dev_multiplier=1.5, corr_window=10, direction=0)
+    params.update(kwargs)
+    return BollingerBandsPolicy(agent=FakeAgent(), **params)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("hold", [0.0, 0.8])
+def test_online_correlation_matches_corrcoef_on_drifting_liquidity(seed, hold):
+    policy = make_policy()
+    policy._kernel_state = None  # Exercise the pure Python running sums
+    corr_window = policy.corr_window
+    prices, liquidity = [], []
+    for price, liq in drifting_series(seed, hold=hold):
+        prices.append(float(price))
+        liquidity.append(float(liq))
+        policy.update_history(prices[-1], liquidity[-1])
+        if len(prices) < corr_window:
+            continue
+
+        x = np.array(prices[-corr_window:])
+        y = np.array(liquidity[-corr_window:])
+        if np.all(x == x[0]) or np.all(y == y[0]):
+            assert policy.calculate_correlation() == 0.0
+        else:
+            assert policy.calculate_correlation() == pytest.approx(np.corrcoef(x, y)[0, 1], abs=1e-9)
+
+
+def reference_trades(series, window: int = 20, corr_window: int = 10, std_dev_multiplier: float = 1.5, direction: int = 0):
+    """Trades of the strategy computed directly with np.mean, np.std and np.corrcoef over each window."""
+    prices = np.array([float(price) for price, _ in series])
+    liquidity = np.array([float(liq) for _, liq in series])
+    trades = []
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for t in range(len(series)):
+            side = 0
+            if t + 1 >= max(window, corr_window):
+                x = prices[t + 1 - window:t + 1]
+                middle, width = x.mean(), x.std() * std_dev_multiplier
+                correlation = np.corrcoef(prices[t + 1 - corr_window:t + 1], liquidity[t + 1 - corr_window:t + 1])[0, 1]
+                if correlation < -0.5:  # False for NaN, i.e. a flat window
+                    if direction >= 0 and prices[t] < middle - width:
+                        side = 1
+                    elif direction <= 0 and prices[t] > middle + width:
+                        side = -1
+            trades.append(side)
+    return trades
+
+
+def replay(policy: BollingerBandsPolicy, series) -> list[int]:
+    """Feed a series through predict() and return 1 for a buy, -1 for a sell and 0 otherwise per step."""
+    obs = FakeObservation()
+    trades = []
+    for price, liquidity in series:
+        obs.current_price, obs.current_liquidity = price, liquidity
+        actions = policy.predict(obs)
+        trades.append(0 if not actions else 1 if actions[0].quantities[0] == 0 else -1)
+    return trades
+
+
+def run_trades(series, kernel: bool, **kwargs) -> list[int]:
+    policy = make_policy(**kwargs)
+    if not kernel:
+        policy._kernel_state = None
+    return replay(policy, series)
+
+
+WINDOWS = [(20, 10), (5, 25), (20, 30)]
+SERIES = [dict(), dict(hold=0.8), dict(price_hold=0.95)]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("window,corr_window", WINDOWS)
+@pytest.mark.parametrize("holds", SERIES)
+def test_kernel_matches_python_path_on_drifting_liquidity(seed, window, corr_window, holds):
+    policy_kernels = pytest.importorskip("policy_kernels")
+    if policy_kernels.update_indicators is None:
+        pytest.skip("numba is not installed")
+    series = drifting_series(seed, **holds)
+    params = dict(window=window, corr_window=corr_window)
+    assert run_trades(series, kernel=True, **params) == run_trades(series, kernel=False, **params)
+
+
+def test_public_indicator_methods_read_the_kernel_state():
+    kernel = make_policy()
+    if kernel._kernel_state is None:
+        pytest.skip("numba is not installed")
+    python = make_policy()
+    python._kernel_state = None
+    series = drifting_series(0, steps=500)
+    replay(kernel, series)
+    replay(python, series)
+    assert kernel.calculate_sma() == pytest.approx(python.calculate_sma(), rel=1e-12)
+    assert kernel.calculate_bollinger_bands() == pytest.approx(python.calculate_bollinger_bands(), rel=1e-12)
+    assert kernel.calculate_correlation() == pytest.approx(python.calculate_correlation(), abs=1e-9)
+    assert kernel.calculate_correlation() != 0.0
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("window,corr_window", WINDOWS)
+@pytest.mark.parametrize("holds", SERIES)
+@pytest.mark.parametrize("direction", [-1, 0, 1])
+def test_all_paths_match_numpy_reference(seed, window, corr_window, holds, direction):
+    series = drifting_series(seed, **holds)
+    params = dict(window=window, corr_window=corr_window, direction=direction)
+    expected = reference_trades(series, **params)
+    assert any(expected)
+
+    precomputed = make_policy(**params)
+    precomputed.precompute([float(price) for price, _ in series], [liquidity for _, liquidity in series])
+    assert replay(precomputed, series) == expected
+    assert run_trades(series, kernel=True, **params) == expected
+    assert run_trades(series, kernel=False, **params) == expected
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_rolling_indicators_correlation_matches_corrcoef(seed):
+    from policy import rolling_indicators
+
+    series = drifting_series(seed)
+    prices = np.array([float(price) for price, _ in series])
+    liquidity = np.array([float(liq) for _, liq in series])
+    corr = rolling_indicators(prices, liquidity, 20, 1.5, 10)[3]
+    for t in range(9, len(series)):
+        expected = np.corrcoef(prices[t - 9:t + 1], liquidity[t - 9:t + 1])[0, 1]
+        assert corr[t] == pytest.approx(0.0 if np.isnan(expected) else expected, abs=1e-9)
+
+
+@pytest.mark.parametrize("direction", [-1, 0, 1])
+@pytest.mark.parametrize("window,k", [(5, 1.0), (20, 1.5), (30, 1.3)])
+def test_sweep_cell_matches_online_path(direction, window, k):
+    from policy import precompute_signals
+
+    series = drifting_series(0, price_hold=0.5)
+    windows, ks = [5, 20, 30], np.arange(1.0, 2.0, 0.1)  # 1.3 and 1.5 are not exact in this grid
+    sweep = precompute_signals([float(price) for price, _ in series], [liq for _, liq in series], windows, ks, 10)
+    assert sweep[0].shape == (len(series), len(windows), len(ks))
+
+    swept = make_policy(window=window, std_dev_multiplier=k, direction=direction)
+    swept.use_signals(*sweep, windows, ks)
+    expected = run_trades(series, kernel=False, window=window, std_dev_multiplier=k, direction=direction)
+    assert any(expected)
+    assert replay(swept, series) == expected
+
+
+def test_use_signals_rejects_parameters_missing_from_the_grid():
+    from policy import precompute_signals
+
+    series = drifting_series(0, steps=100)
+    sweep = precompute_signals([float(price) for price, _ in series], [liq for _, liq in series], [20], [1.0, 2.0], 10)
+    with pytest.raises(ValueError, match="std_dev_multiplier 1.5"):
+        make_policy(std_dev_multiplier=1.5).use_signals(*sweep, [20], [1.0, 2.0])
+    with pytest.raises(ValueError, match="window 30"):
+        make_policy(window=30, std_dev_multiplier=1.0).use_signals(*sweep, [20], [1.0, 2.0])